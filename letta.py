@@ -9,9 +9,13 @@ license: MIT
 """
 
 import os
+import ssl
 import json
 import time
-import urllib3
+import random
+import asyncio
+import aiohttp
+from yarl import URL
 from datetime import datetime
 from pathlib import Path
 from typing import List, Union, Iterator, Generator, Callable, Awaitable, Any
@@ -19,32 +23,57 @@ from pydantic import BaseModel, Field
 from fastapi import Request
 from open_webui.utils.chat import generate_chat_completion
 from open_webui.models.users import Users
-from tenacity import (
-    retry,
-    stop_after_attempt,
-    wait_exponential,
-    retry_if_exception_type,
-)
 
-# Disable SSL warnings temporarily
-urllib3.disable_warnings()
+try:
+    import orjson
+
+    def _dumps(obj: Any) -> str:
+        # Dev output may include header mappings keyed by str subclasses
+        return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    _loads = orjson.loads
+    _dumps_bytes = orjson.dumps
+except ImportError:
+    def _dumps(obj: Any) -> str:
+        return json.dumps(obj, default=str)
+
+    def _dumps_bytes(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    _loads = json.loads
+
+# SSE framing markers, matched against raw response bytes
+_DATA_PREFIX = b"data: "
+_DONE = b"data: [DONE]"
 
 
 class Pipe:
-    @retry(
-        stop=stop_after_attempt(3),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry=retry_if_exception_type(
-            (urllib3.exceptions.TimeoutError, urllib3.exceptions.HTTPError)
-        ),
-    )
-    def _send_request(self, method: str, url: str, **kwargs):
+    async def _send_request(self, method: str, url: URL, **kwargs) -> aiohttp.ClientResponse:
         if self.valves.DEV_MODE:
             self._dev_print(f"Sending request to URL: {url}", "DEBUG")
             self._dev_print(f"Method: {method}", "DEBUG")
-            self._dev_print(f"Kwargs: {json.dumps(kwargs, indent=2)}", "DEBUG")
-            self._dev_print(f"URL components: {urllib3.util.parse_url(url)}", "DEBUG")
-        return self.http.request(method, url, **kwargs)
+            self._dev_print(f"Kwargs: {_dumps(kwargs)}", "DEBUG")
+        session = await self._get_session()
+        # Picked per request, so toggling VERIFY_SSL never disturbs the
+        # shared session or streams already in flight
+        kwargs.setdefault("ssl", self._ssl_contexts[self.valves.VERIFY_SSL])
+        return await session.request(method, url, **kwargs)
+
+    async def _send_request_async(self, method: str, url: URL, attempts: int = 3, **kwargs):
+        """Send a request, retrying transient failures with jittered backoff.
+
+        Waits use asyncio.sleep so a retry does not stall the event loop.
+        """
+        for attempt in range(attempts):
+            try:
+                return await self._send_request(method, url, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == attempts - 1:
+                    raise
+                delay = min(10, max(4, 2 ** attempt)) + random.uniform(0, 1)
+                if self.valves.DEV_MODE:
+                    self._dev_print(f"Request failed ({e}), retrying in {delay:.1f}s", "WARNING")
+                await asyncio.sleep(delay)
 
     class Valves(BaseModel):
         LETTA_BASE_URL: str = Field(
@@ -59,6 +88,10 @@ class Pipe:
             default=os.getenv("LETTA_PASSWORD", ""),
             description="Password for Letta authentication",
         )
+        VERIFY_SSL: bool = Field(
+            default=False,
+            description="Verify the Letta server's TLS certificate"
+        )
         ENABLE_TOOLS: bool = Field(
             default=True, 
             description="Enable Open WebUI tool integration"
@@ -119,47 +152,181 @@ class Pipe:
         self.type = "manifold"
         self.name = "Letta: "
         self.valves = self.Valves()
-        self.http = urllib3.PoolManager(
-            cert_reqs="CERT_NONE",
-            headers={
-                "X-BARE-PASSWORD": f"password {self.valves.LETTA_PASSWORD}",
-                "Content-Type": "application/json",
-                "Accept": "text/event-stream",
-            },
-        )
+        self._session = None
+        # Both TLS contexts are built once and shared by every connection
+        verified = ssl.create_default_context()
+        unverified = ssl.create_default_context()
+        unverified.check_hostname = False
+        unverified.verify_mode = ssl.CERT_NONE
+        self._ssl_contexts = {True: verified, False: unverified}
+        self._client_key = None
+        self._refresh_client()
+        self._log_fd = None
+        self._log_fd_path = None
+        self._log_q = None
+        self._log_task = None
+        self._ts_sec = None
+        self._ts_prefixes = None
         # Initialize response log file in dev mode
         if self.valves.DEV_MODE and self.valves.SAVE_RESPONSES:
             self._init_response_log()
 
+    def _refresh_client(self):
+        """Rebuild cached request state if connection-related valves changed.
+
+        Valves can be replaced without on_valves_updated being called, so
+        this runs per request; the common case is a single tuple compare.
+        """
+        key = (
+            self.valves.LETTA_BASE_URL,
+            self.valves.LETTA_PASSWORD,
+            self.valves.LETTA_AGENT_ID,
+        )
+        if key == self._client_key:
+            return
+
+        self._headers = {
+            "X-BARE-PASSWORD": f"password {self.valves.LETTA_PASSWORD}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+        }
+        # Pre-parsed so aiohttp does not re-parse the URL on every request
+        self._stream_url = URL(
+            f"{self.valves.LETTA_BASE_URL}/v1/agents/{self.valves.LETTA_AGENT_ID}/messages/stream"
+        )
+        self._pipes_response = [
+            {
+                "id": f"letta.{self.valves.LETTA_AGENT_ID}",
+                "name": f"Letta",
+                "meta": {
+                    "provider": "letta",
+                    "agent_id": self.valves.LETTA_AGENT_ID,
+                    "profile": {
+                        "name": "Letta",
+                        "description": "A helpful AI assistant that can engage in natural conversations and help with various tasks.",
+                        "avatar": "https://letta2.oculair.ca/static/letta-avatar.png"
+                    }
+                },
+            }
+        ]
+        self._client_key = key
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use.
+
+        The session has to be created inside the running event loop, and
+        its connector keeps TLS connections to Letta alive between calls.
+        """
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=20, limit_per_host=10),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30),
+            )
+        return self._session
+
     def _init_response_log(self):
-        """Initialize the response log file with a header"""
+        """Initialize the response log file with a header and open it for appending"""
+        self._close_response_log()
         log_path = Path(self.valves.RESPONSE_LOG_PATH)
         if not log_path.exists():
             with open(log_path, 'w', encoding='utf-8') as f:
                 f.write('# Letta Response Log\n')
                 f.write(f'# Created: {datetime.now().isoformat()}\n')
                 f.write('# Format: {"timestamp": "", "type": "", "content": ""}\n\n')
+        # O_APPEND makes the kernel position each write at end of file, so
+        # whole-line writes from other workers sharing the log never interleave
+        self._log_fd = os.open(log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._log_fd_path = self.valves.RESPONSE_LOG_PATH
+
+    def _close_response_log(self):
+        """Close the response log file if it is open"""
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            self._log_fd = None
+
+    def _write_log_batch(self, data: bytes):
+        """Append a batch of serialized log lines to the response log file"""
+        # Reopen if the log path was changed after startup
+        if self._log_fd is None or self._log_fd_path != self.valves.RESPONSE_LOG_PATH:
+            self._init_response_log()
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self._log_fd, view):]
+
+    async def _log_drain(self):
+        """Drain queued log entries to disk in batches"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._log_q.get()]
+            while len(batch) < 128 and not self._log_q.empty():
+                batch.append(self._log_q.get_nowait())
+            lines = []
+            for ts, type_, content, raw in batch:
+                if raw:
+                    # Content is already serialized JSON; splice it in as-is
+                    lines.append(
+                        b'{"timestamp":"' + ts.encode() + b'","type":"'
+                        + type_.encode() + b'","content":' + content + b'}\n'
+                    )
+                else:
+                    lines.append(
+                        _dumps_bytes({"timestamp": ts, "type": type_, "content": content})
+                        + b"\n"
+                    )
+            data = b"".join(lines)
+            try:
+                # Only the file I/O leaves the loop; encoding stays on this task
+                await loop.run_in_executor(None, self._write_log_batch, data)
+            except OSError as e:
+                print(f"Failed to write response log: {e}")
+            finally:
+                for _ in batch:
+                    self._log_q.task_done()
 
-    def _log_response(self, response_type: str, content: Any):
-        """Log a response to the response log file"""
+    def _log_response(self, response_type: str, content: Any, raw: bool = False):
+        """Queue a response entry for the background log writer.
+
+        With raw=True, content is JSON bytes that are written verbatim.
+        """
         if not (self.valves.DEV_MODE and self.valves.SAVE_RESPONSES):
             return
 
-        log_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "type": response_type,
-            "content": content
-        }
-        
-        with open(self.valves.RESPONSE_LOG_PATH, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(log_entry) + '\n')
+        loop = asyncio.get_running_loop()
+        if (
+            self._log_task is None
+            or self._log_task.done()
+            or self._log_task.get_loop() is not loop
+        ):
+            self._log_q = asyncio.Queue(maxsize=4096)
+            self._log_task = loop.create_task(self._log_drain())
+
+        t = time.time()
+        timestamp = f"{self._timestamp_prefixes(t)[1]}.{int(t % 1 * 1_000_000):06d}"
+        try:
+            self._log_q.put_nowait((timestamp, response_type, content, raw))
+        except asyncio.QueueFull:
+            # Logging must never stall the stream; drop the entry instead
+            pass
+
+    def _timestamp_prefixes(self, t: float) -> tuple:
+        """Return the (display, ISO) date-time prefixes for t, cached per second"""
+        sec = int(t)
+        if sec != self._ts_sec:
+            lt = time.localtime(sec)
+            self._ts_sec = sec
+            self._ts_prefixes = (
+                time.strftime("%Y-%m-%d %H:%M:%S", lt),
+                time.strftime("%Y-%m-%dT%H:%M:%S", lt),
+            )
+        return self._ts_prefixes
 
     def _dev_print(self, message: str, level: str = "INFO"):
         """Print development messages if dev mode is enabled"""
         if not self.valves.DEV_MODE:
             return
-            
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+
+        t = time.time()
+        timestamp = f"{self._timestamp_prefixes(t)[0]}.{int(t % 1 * 1000):03d}"
         print(f"[{timestamp}] [{level}] {message}")
 
     async def _dev_event(self, event_type: str, data: Any, event_emitter: Callable = None):
@@ -169,7 +336,7 @@ class Pipe:
 
         if self.valves.LOG_EVENTS:
             self._dev_print(
-                f"Event: {event_type}\nData: {json.dumps(data, indent=2)}", 
+                f"Event: {event_type}\nData: {_dumps(data)}", 
                 "EVENT"
             )
             
@@ -181,21 +348,8 @@ class Pipe:
 
     def pipes(self) -> List[dict]:
         """Fetch available Letta configurations"""
-        return [
-            {
-                "id": f"letta.{self.valves.LETTA_AGENT_ID}",
-                "name": f"Letta",
-                "meta": {
-                    "provider": "letta",
-                    "agent_id": self.valves.LETTA_AGENT_ID,
-                    "profile": {
-                        "name": "Letta",
-                        "description": "A helpful AI assistant that can engage in natural conversations and help with various tasks.",
-                        "avatar": "https://letta2.oculair.ca/static/letta-avatar.png"
-                    }
-                },
-            }
-        ]
+        self._refresh_client()
+        return self._pipes_response
 
     async def pipe(
         self, 
@@ -221,9 +375,9 @@ class Pipe:
                 user = Users.get_user_by_id(__user__["id"])
                 return await generate_chat_completion(__request__, body, user)
 
-            # Process messages
-            messages = self._format_messages(body["messages"])
-            last_message = messages[-1] if messages else {}
+            # Only the last message is sent to Letta, so only it is converted
+            messages = body["messages"]
+            last_message = self._format_message(messages[-1]) if messages else {}
 
             # Send initial status event
             if display_events:
@@ -243,21 +397,15 @@ class Pipe:
                 "stream_tokens": True,
             }
 
-            # Construct URL
-            url = f"{self.valves.LETTA_BASE_URL}/v1/agents/{self.valves.LETTA_AGENT_ID}/messages/stream"
+            # Request URL and headers are cached per valve configuration
+            self._refresh_client()
             if self.valves.DEV_MODE:
-                self._dev_print(f"Constructed URL: {url}", "DEBUG")
-                parsed = urllib3.util.parse_url(url)
-                self._dev_print(f"Parsed URL: {parsed}", "DEBUG")
+                self._dev_print(f"Constructed URL: {self._stream_url}", "DEBUG")
 
             return self._handle_streaming(
-                url=url,
+                url=self._stream_url,
                 payload=payload,
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "text/event-stream",
-                    "X-BARE-PASSWORD": f"password {self.valves.LETTA_PASSWORD}",
-                },
+                headers=self._headers,
                 display_events=display_events,
                 event_emitter=__event_emitter__,
                 user_valves=user_valves
@@ -274,20 +422,16 @@ class Pipe:
                 })
             return f"Letta Error: {str(e)}"
 
-    def _format_messages(self, messages: list) -> list:
-        """Convert Open WebUI format to Letta format"""
-        formatted = []
-        for msg in messages:
-            formatted_msg = {
-                "role": "system" if msg["role"] == "system" else "user",
-                "content": msg["content"],
-            }
-            formatted.append(formatted_msg)
-        return formatted
+    def _format_message(self, msg: dict) -> dict:
+        """Convert an Open WebUI message to Letta format"""
+        return {
+            "role": "system" if msg["role"] == "system" else "user",
+            "content": msg["content"],
+        }
 
     def _handle_streaming(
         self, 
-        url: str, 
+        url: URL, 
         payload: dict, 
         headers: dict,
         display_events: bool = False,
@@ -298,111 +442,176 @@ class Pipe:
 
         async def generator():
             response = None
+            # Valve checks are constant for the life of the stream, so they
+            # are resolved once here and the frame loop only tests locals
+            dev_mode = self.valves.DEV_MODE
+            log_raw = dev_mode and self.valves.LOG_RAW_CHUNKS
+            log_parsed = dev_mode and self.valves.LOG_PARSED_CHUNKS
+            emit_usage = display_events and user_valves.SHOW_USAGE_STATS
+            emit_reasoning = display_events and user_valves.SHOW_REASONING
             try:
                 # Development logging: Request details
-                if self.valves.DEV_MODE:
+                if dev_mode:
                     self._dev_print(f"Request URL: {url}", "DEBUG")
                     self._dev_print(f"Base URL: {self.valves.LETTA_BASE_URL}", "DEBUG")
                     self._dev_print(f"Agent ID: {self.valves.LETTA_AGENT_ID}", "DEBUG")
-                    self._dev_print(f"Request Headers: {json.dumps(headers, indent=2)}", "DEBUG")
-                    self._dev_print(f"Request Payload: {json.dumps(payload, indent=2)}", "DEBUG")
+                    self._dev_print(f"Request Headers: {_dumps(headers)}", "DEBUG")
+                    self._dev_print(f"Request Payload: {_dumps(payload)}", "DEBUG")
 
                 # Send request
-                response = self._send_request(
+                response = await self._send_request_async(
                     "POST",
                     url,
-                    body=json.dumps(payload),
-                    preload_content=False,
+                    data=_dumps_bytes(payload),
                     headers=headers,
                 )
 
                 # Development logging: Response status
-                if self.valves.DEV_MODE:
+                if dev_mode:
                     self._dev_print(f"Response Status: {response.status}", "DEBUG")
-                    self._dev_print(f"Response Headers: {json.dumps(dict(response.headers), indent=2)}", "DEBUG")
-
-                # Process streaming response
-                for chunk in response.stream():
-                    decoded_chunk = chunk.decode("utf-8")
-                    
+                    self._dev_print(f"Response Headers: {_dumps(dict(response.headers))}", "DEBUG")
+
+                # Fast path: with no events to emit and no dev logging, the
+                # only work per frame is to parse it and yield assistant text
+                if not (display_events or dev_mode):
+                    buf = bytearray()
+                    async for raw in response.content.iter_chunked(16384):
+                        buf += raw
+                        start = 0
+                        while True:
+                            end = buf.find(b"\n\n", start)
+                            if end < 0:
+                                break
+                            frame = buf[start:end]
+                            start = end + 2
+                            if not frame.startswith(_DATA_PREFIX) or frame == _DONE:
+                                continue
+                            try:
+                                chunk_data = _loads(frame[6:])
+                            except json.JSONDecodeError:
+                                continue
+                            if chunk_data.get("message_type") == "assistant_message":
+                                content = chunk_data.get("content")
+                                if content:
+                                    yield content
+                        del buf[:start]
+                    return
+
+                # Message handlers return the text to stream, if any. Handlers
+                # for event-only message types are registered only when those
+                # events will be shown, so per-frame dispatch is one dict get.
+                async def on_assistant(chunk_data: dict):
+                    content = chunk_data.get("content", "")
+                    if content:
+                        # Clear the processing status when we get the first message
+                        if display_events:
+                            await self._dev_event(
+                                "status",
+                                None,  # Clear the status
+                                event_emitter
+                            )
+                        if dev_mode:
+                            self._log_response("assistant_message", content)
+                    return content
+
+                async def on_usage(chunk_data: dict):
+                    if dev_mode:
+                        self._log_response("usage_stats", chunk_data)
+                    await self._dev_event("usage", chunk_data, event_emitter)
+
+                async def on_reasoning(chunk_data: dict):
+                    reasoning_data = {
+                        "step": chunk_data.get("step", "unknown"),
+                        "content": chunk_data.get("content", "")
+                    }
+                    if dev_mode:
+                        self._log_response("reasoning", reasoning_data)
+                    await self._dev_event("reasoning", reasoning_data, event_emitter)
+
+                handlers = {"assistant_message": on_assistant}
+                if emit_usage:
+                    handlers["usage_statistics"] = on_usage
+                if emit_reasoning:
+                    handlers["reasoning_message"] = on_reasoning
+
+                # Process streaming response; SSE framing is ASCII, so frames
+                # are matched and parsed as bytes without decoding the chunk.
+                # A frame may straddle two reads, so the unterminated tail of
+                # each read is carried over into the next one. Reads return as
+                # soon as any data is buffered (aiohttp already disables Nagle
+                # on its sockets), so the bound only caps how much of a burst
+                # is handled per loop iteration.
+                buf = bytearray()
+                async for raw in response.content.iter_chunked(16384):
                     # Development logging: Raw chunk
-                    if self.valves.DEV_MODE and self.valves.LOG_RAW_CHUNKS:
+                    if log_raw:
+                        decoded_chunk = raw.decode("utf-8", errors="replace")
                         self._dev_print(f"Raw Chunk:\n{decoded_chunk}", "CHUNK")
                         self._log_response("raw_chunk", decoded_chunk)
 
-                    chunks = decoded_chunk.split("\n\n")
-                    for chunk in chunks:
-                        if not chunk.startswith("data: "):
+                    # Walk complete frames in place rather than splitting the
+                    # buffer into a list, then drop the consumed prefix once
+                    buf += raw
+                    start = 0
+                    while True:
+                        end = buf.find(b"\n\n", start)
+                        if end < 0:
+                            break
+                        frame = buf[start:end]
+                        start = end + 2
+
+                        # Skip blank keep-alive frames before the prefix check
+                        if not frame or not frame.startswith(_DATA_PREFIX):
                             continue
 
                         # Handle [DONE] marker
-                        if chunk == "data: [DONE]":
-                            if self.valves.DEV_MODE:
+                        if frame == _DONE:
+                            if dev_mode:
                                 self._dev_print("Received [DONE] marker", "DEBUG")
                                 self._log_response("done_marker", "[DONE]")
                             continue
 
                         try:
-                            chunk_data = json.loads(chunk[6:])
-                            
-                            # Development logging: Parsed chunk
-                            if self.valves.DEV_MODE and self.valves.LOG_PARSED_CHUNKS:
+                            raw_json = frame[6:]
+                            chunk_data = _loads(raw_json)
+
+                            # Development logging: Parsed chunk. The frame is
+                            # already JSON, so reuse it instead of re-encoding
+                            if log_parsed:
                                 self._dev_print(
-                                    f"Parsed Chunk:\n{json.dumps(chunk_data, indent=2)}", 
+                                    f"Parsed Chunk:\n{raw_json.decode('utf-8', errors='replace')}",
                                     "PARSED"
                                 )
-                                self._log_response("parsed_chunk", chunk_data)
-
-                            message_type = chunk_data.get("message_type")
+                                self._log_response("parsed_chunk", bytes(raw_json), raw=True)
 
-                            if message_type == "assistant_message":
-                                content = chunk_data.get("content", "")
+                            handler = handlers.get(chunk_data.get("message_type"))
+                            if handler is not None:
+                                content = await handler(chunk_data)
+                                # Open WebUI treats each yield as a delta, so
+                                # tokens are passed through without framing
                                 if content:
-                                    # Clear the processing status when we get the first message
-                                    if display_events:
-                                        await self._dev_event(
-                                            "status",
-                                            None,  # Clear the status
-                                            event_emitter
-                                        )
-                                    if self.valves.DEV_MODE:
-                                        self._log_response("assistant_message", content)
-                                    yield content + "\n"
-                                    
-                            elif message_type == "usage_statistics" and user_valves.SHOW_USAGE_STATS:
-                                if display_events:
-                                    if self.valves.DEV_MODE:
-                                        self._log_response("usage_stats", chunk_data)
-                                    await self._dev_event("usage", chunk_data, event_emitter)
-                                    
-                            elif message_type == "reasoning_message" and user_valves.SHOW_REASONING:
-                                if display_events:
-                                    reasoning_data = {
-                                        "step": chunk_data.get("step", "unknown"),
-                                        "content": chunk_data.get("content", "")
-                                    }
-                                    if self.valves.DEV_MODE:
-                                        self._log_response("reasoning", reasoning_data)
-                                    await self._dev_event("reasoning", reasoning_data, event_emitter)
+                                    yield content
 
                         except json.JSONDecodeError as e:
-                            if self.valves.DEV_MODE:
+                            if dev_mode:
                                 self._dev_print(f"JSON Parse Error: {str(e)}", "ERROR")
                                 self._log_response("parse_error", {
                                     "error": str(e),
-                                    "chunk": chunk
+                                    "chunk": frame.decode("utf-8", errors="replace")
                                 })
                             if display_events:
                                 await self._dev_event(
                                     "warning",
                                     {
                                         "message": "Failed to parse chunk",
-                                        "chunk": chunk,
+                                        "chunk": frame.decode("utf-8", errors="replace"),
                                         "error": str(e)
                                     },
                                     event_emitter
                                 )
 
+                    del buf[:start]
+
                 # All done - status was cleared when message arrived
 
             except Exception as e:
@@ -410,18 +619,19 @@ class Pipe:
                     "error": str(e),
                     "type": type(e).__name__
                 }
-                if self.valves.DEV_MODE:
+                if dev_mode:
                     self._dev_print(f"Streaming Error: {str(e)}", "ERROR")
                     self._log_response("error", error_data)
                 if display_events:
                     await self._dev_event("error", error_data, event_emitter)
-                yield json.dumps({
+                yield _dumps({
                     "type": "chat:error",
                     "data": {"message": f"Error during streaming: {str(e)}"}
                 })
             finally:
+                # Return the connection to the pool for keep-alive reuse
                 if response is not None:
-                    response.release_conn()
+                    response.release()
 
         return generator()
 
@@ -431,18 +641,31 @@ class Pipe:
             return f"Error: {response.status} - {response.data.decode()}"
 
         try:
-            data = json.loads(response.data.decode())
+            data = _loads(response.data)
             return data["choices"][0]["message"]["content"]
         except KeyError:
             return "Error: Invalid response format from Letta"
 
     async def on_valves_updated(self):
-        """Update HTTP client when valves change"""
-        self.http = urllib3.PoolManager(
-            cert_reqs="CERT_NONE",
-            headers={
-                "X-BARE-PASSWORD": f"password {self.valves.LETTA_PASSWORD}",
-                "Content-Type": "application/json",
-                "Accept": "text/event-stream",
-            },
-        )
\ No newline at end of file
+        """Update HTTP client when connection-related valves change"""
+        self._refresh_client()
+
+    async def on_shutdown(self):
+        """Release the response log handle and the HTTP session"""
+        if self._log_task is not None:
+            # Let queued entries reach the file before stopping the drain;
+            # a drain that already died would never empty the queue
+            if not self._log_task.done():
+                await self._log_q.join()
+            self._log_task.cancel()
+            try:
+                await self._log_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                print(f"Response log writer failed: {e}")
+            self._log_task = None
+        self._close_response_log()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
@@ -6,8 +6,10 @@ version: 0.3.0
 license: MIT
 """
 
+import io
 import os
 import json
+import asyncio
 import logging
 import aiohttp
 from datetime import datetime
@@ -17,7 +19,22 @@ from pydantic import BaseModel, Field
 from fastapi import Request
 from open_webui.utils.chat import generate_chat_completion
 from open_webui.models.users import Users
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumps_bytes = orjson.dumps
+except ImportError:
+    def _dumps_bytes(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    _loads = json.loads
+
+# SSE framing markers, matched against raw response bytes
+_DATA_PREFIX = b"data: "
+_DONE = b"data: [DONE]"
 
 # Constants
 class TASKS:
@@ -42,12 +59,26 @@ def setup_logger():
 
 logger = setup_logger()
 
-@dataclass
 class User:
-    id: str
-    email: str
-    name: str
-    role: str
+    """Minimal user passed to generate_chat_completion for task requests"""
+    __slots__ = ("id", "email", "name", "role")
+
+    def __init__(self, *, id: str, email: str, name: str, role: str, **_ignored: Any):
+        # Open WebUI passes extra user fields; they are not needed here
+        self.id = id
+        self.email = email
+        self.name = name
+        self.role = role
+
+@dataclass
+class StreamState:
+    """Per-response state shared by the stream message handlers"""
+    loop: asyncio.AbstractEventLoop
+    last_flush: float
+    response_content: io.StringIO = field(default_factory=io.StringIO)
+    pending: List[str] = field(default_factory=list)
+    pending_len: int = 0
+    status_cleared: bool = False
 
 class Pipe:
     class Valves(BaseModel):
@@ -103,10 +134,38 @@ class Pipe:
         self.type = "manifold"
         self.name = "Letta: "
         self.valves = self.Valves()
+        self._session = None
+        self._log_fh = None
+        self._log_fh_path = None
+        self._log_queue = None
+        self._writer_task = None
+        self._user_cache: Dict[tuple, User] = {}
+        self._handlers = {
+            "assistant_message": self._on_assistant,
+            "usage_statistics": self._on_usage,
+            "reasoning_message": self._on_reasoning,
+        }
+        self._cached_key = None
+        self._cached_url = None
+        self._cached_headers = None
+        self._materialize()
         # Initialize response log file in dev mode
         if self.valves.DEV_MODE and self.valves.SAVE_RESPONSES:
             self._init_response_log()
 
+    def _materialize(self):
+        """Build the stream URL and request headers from the current valves"""
+        key = (self.valves.LETTA_BASE_URL, self.valves.LETTA_AGENT_ID, self.valves.LETTA_PASSWORD)
+        if key == self._cached_key:
+            return
+        self._cached_key = key
+        self._cached_url = f"{self.valves.LETTA_BASE_URL}/v1/agents/{self.valves.LETTA_AGENT_ID}/messages/stream"
+        self._cached_headers = {
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+            "X-BARE-PASSWORD": f"password {self.valves.LETTA_PASSWORD}"
+        }
+
     def _init_response_log(self):
         """Initialize the response log file with a header"""
         log_path = Path(self.valves.RESPONSE_LOG_PATH)
@@ -116,27 +175,111 @@ class Pipe:
                 f.write(f'# Created: {datetime.now().isoformat()}\n')
                 f.write('# Format: {"timestamp": "", "type": "", "content": ""}\n\n')
 
+    def _close_response_log(self):
+        """Flush and close the response log file if it is open"""
+        if self._log_fh is not None:
+            self._log_fh.close()
+            self._log_fh = None
+
+    def _write_log_batch(self, data: bytes):
+        """Append serialized log lines to the response log file"""
+        # Only the writer task calls this, so it owns the file handle.
+        # Open lazily, and reopen if the log path was changed after startup
+        if self._log_fh is None or self._log_fh_path != self.valves.RESPONSE_LOG_PATH:
+            self._close_response_log()
+            self._init_response_log()
+            self._log_fh = open(self.valves.RESPONSE_LOG_PATH, 'ab', buffering=1 << 16)
+            self._log_fh_path = self.valves.RESPONSE_LOG_PATH
+        self._log_fh.write(data)
+        # Flushing per batch keeps `tail -f` useful
+        self._log_fh.flush()
+
+    async def _log_writer(self):
+        """Drain queued log entries to the response log file"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._log_queue.get()]
+            while not self._log_queue.empty():
+                batch.append(self._log_queue.get_nowait())
+            data = b"".join(_dumps_bytes(entry) + b'\n' for entry in batch)
+            try:
+                # Keep disk I/O off the event loop
+                await loop.run_in_executor(None, self._write_log_batch, data)
+            except OSError as e:
+                logger.error("Failed to write response log: %s", e)
+            finally:
+                for _ in batch:
+                    self._log_queue.task_done()
+
     def _log_response(self, response_type: str, content: Any):
-        """Log a response to the response log file"""
+        """Queue a response entry for the background log writer"""
         if not (self.valves.DEV_MODE and self.valves.SAVE_RESPONSES):
             return
 
+        loop = asyncio.get_running_loop()
+        if (
+            self._writer_task is None
+            or self._writer_task.done()
+            or self._writer_task.get_loop() is not loop
+        ):
+            self._log_queue = asyncio.Queue(maxsize=1024)
+            self._writer_task = loop.create_task(self._log_writer())
+
         log_entry = {
             "timestamp": datetime.now().isoformat(),
             "type": response_type,
             "content": content
         }
-        
-        with open(self.valves.RESPONSE_LOG_PATH, 'a', encoding='utf-8') as f:
-            f.write(json.dumps(log_entry) + '\n')
 
-    async def emit_message(self, event_emitter: Callable, message: str):
-        """Emit a message event"""
-        if event_emitter is not None:
-            await event_emitter({
-                "type": "message",
-                "data": {"content": message}
-            })
+        try:
+            self._log_queue.put_nowait(log_entry)
+        except asyncio.QueueFull:
+            # Logging must never stall a response; drop the oldest entry
+            self._log_queue.get_nowait()
+            self._log_queue.task_done()
+            self._log_queue.put_nowait(log_entry)
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=100, keepalive_timeout=60)
+            )
+        return self._session
+
+    async def aclose(self):
+        """Close the shared HTTP session and the response log file"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._writer_task is not None:
+            # Let queued entries reach the file before stopping the writer
+            if not self._writer_task.done():
+                await self._log_queue.join()
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.error("Response log writer failed: %s", e)
+            self._writer_task = None
+        self._close_response_log()
+
+    async def on_shutdown(self):
+        """Release resources when Open WebUI shuts down"""
+        await self.aclose()
+
+    def _get_user(self, user: dict) -> User:
+        """Return a cached User for the given Open WebUI user dict"""
+        key = (user["id"], user["email"], user["name"], user["role"])
+        cached = self._user_cache.get(key)
+        if cached is None:
+            if len(self._user_cache) >= 128:
+                # Evict the oldest entry
+                del self._user_cache[next(iter(self._user_cache))]
+            cached = self._user_cache[key] = User(**user)
+        return cached
 
     async def emit_status(self, event_emitter: Callable, level: str, message: str, done: bool):
         """Emit a status event"""
@@ -151,6 +294,82 @@ class Pipe:
                 },
             })
 
+    async def _flush_pending(self, event_emitter: Callable, state: StreamState):
+        """Emit buffered assistant content as a single message event"""
+        if state.pending:
+            await event_emitter({
+                "type": "message",
+                "data": {"content": "".join(state.pending)}
+            })
+            state.pending.clear()
+            state.pending_len = 0
+        state.last_flush = state.loop.time()
+
+    async def _on_assistant(self, chunk_data: dict, event_emitter: Callable, user_valves: UserValves, state: StreamState):
+        """Collect assistant content and stream it in coalesced events"""
+        content = chunk_data.get("content", "")
+        if not content:
+            return
+
+        # Tokens are fragments of one reply, so they are concatenated as-is
+        state.response_content.write(content)
+        if event_emitter is None:
+            return
+        # Clear processing status on the first content
+        if not state.status_cleared:
+            await self.emit_status(event_emitter, "info", "", True)
+            state.status_cleared = True
+        # Streamed tokens are coalesced into message events of at least 64
+        # chars, or whatever arrived within 20ms, so each token does not
+        # cost its own event emitter round-trip
+        state.pending.append(content)
+        state.pending_len += len(content)
+        if state.pending_len >= 64 or state.loop.time() - state.last_flush > 0.02:
+            await self._flush_pending(event_emitter, state)
+
+    async def _on_usage(self, chunk_data: dict, event_emitter: Callable, user_valves: UserValves, state: StreamState):
+        """Forward usage statistics as a usage event"""
+        if event_emitter is None or not getattr(user_valves, "SHOW_USAGE_STATS", True):
+            return
+        # Buffered content goes out before anything that follows it
+        await self._flush_pending(event_emitter, state)
+        if self.valves.DEV_MODE and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Usage statistics: %s", chunk_data)
+        await event_emitter({
+            "type": "usage",
+            "data": chunk_data
+        })
+
+    async def _on_reasoning(self, chunk_data: dict, event_emitter: Callable, user_valves: UserValves, state: StreamState):
+        """Show a reasoning step in the status line and as a reasoning event"""
+        if event_emitter is None or not getattr(user_valves, "SHOW_REASONING", True):
+            return
+        # Get the message directly
+        message = chunk_data.get("message", "")
+        if message:
+            if self.valves.DEV_MODE and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Reasoning message: %s", message)
+
+            # Buffered content goes out before anything that follows it
+            await self._flush_pending(event_emitter, state)
+            # Content after this step clears the reasoning status again
+            state.status_cleared = False
+
+            # Update status with reasoning message
+            await self.emit_status(
+                event_emitter,
+                "info",
+                f"🤔 {message}",
+                False
+            )
+            # Also emit reasoning event for other UI elements
+            await event_emitter({
+                "type": "reasoning",
+                "data": {
+                    "message": message
+                }
+            })
+
     def pipes(self) -> List[dict]:
         """Fetch available Letta configurations"""
         return [
@@ -179,31 +398,33 @@ class Pipe:
 
     def update_settings(self, settings: dict) -> None:
         """Update function settings"""
+        self._materialize()
         if "dev_mode" in settings:
             self.valves.DEV_MODE = settings["dev_mode"]
             if self.valves.DEV_MODE and self.valves.SAVE_RESPONSES:
                 self._init_response_log()
 
-    async def format_messages(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
-        """Format messages according to the Letta API specification"""
-        formatted_messages = []
-        for msg in messages:
+    def format_messages(self, messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """Format the last supported message according to the Letta API specification"""
+        # Only the last message is sent, so scan from the tail instead of
+        # converting the whole history
+        formatted_messages = None
+        for msg in reversed(messages):
+            role = msg.get("role")
             # Only include supported roles
-            if msg.get("role") not in ["user", "system", "assistant"]:
-                continue
-
-            formatted_msg = {
-                "role": "system" if msg["role"] == "system" else "user",
-                "content": msg.get("content", ""),
-            }
-            formatted_messages.append(formatted_msg)
+            if role in ("user", "system", "assistant"):
+                formatted_messages = [{
+                    "role": "system" if role == "system" else "user",
+                    "content": msg.get("content", ""),
+                }]
+                break
 
         # Ensure we have at least one message
-        if not formatted_messages:
-            formatted_messages.append({"role": "user", "content": "Hello"})
+        if formatted_messages is None:
+            formatted_messages = [{"role": "user", "content": "Hello"}]
 
-        if self.valves.DEV_MODE:
-            logger.debug(f"Formatted messages: {json.dumps(formatted_messages, indent=2)}")
+        if self.valves.DEV_MODE and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Formatted messages: %s", _dumps_bytes(formatted_messages).decode())
         return formatted_messages
 
     async def get_letta_response(
@@ -213,102 +434,117 @@ class Pipe:
         user_valves: UserValves = None
     ) -> str:
         """Send messages to the Letta agent and get its response"""
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "text/event-stream",
-            "X-BARE-PASSWORD": f"password {self.valves.LETTA_PASSWORD}"
-        }
+        # Valves can also be replaced directly, so re-check the cheap key
+        self._materialize()
+        headers = self._cached_headers
+        url = self._cached_url
 
-        formatted_messages = await self.format_messages(messages)
+        formatted_messages = self.format_messages(messages)
         payload = {
             "messages": [formatted_messages[-1]],  # Send only the last message
             "stream_steps": True,
             "stream_tokens": True,
         }
 
-        url = f"{self.valves.LETTA_BASE_URL}/v1/agents/{self.valves.LETTA_AGENT_ID}/messages/stream"
+        # Serialized once with orjson when available; aiohttp's json= would
+        # run the stdlib encoder instead
+        body_bytes = _dumps_bytes(payload)
 
-        if self.valves.DEV_MODE:
-            logger.debug(f"Sending request to {url}")
-            logger.debug(f"Request data: {json.dumps(payload, indent=2)}")
+        # Resolved once per request; the stream loop checks this local
+        debug = self.valves.DEV_MODE and logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("Sending request to %s", url)
+            logger.debug("Request data: %s", body_bytes.decode())
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=payload) as response:
-                    if response.status == 422:
-                        error_text = await response.text()
-                        logger.error(f"API Validation Error: {error_text}")
-                        raise ValueError(f"API Validation Error: {error_text}")
-
-                    response.raise_for_status()
+            # Reuse one session so keep-alive connections to Letta persist
+            session = await self._get_session()
+            async with session.post(url, headers=headers, data=body_bytes) as response:
+                if response.status == 422:
+                    error_text = await response.text()
+                    logger.error(f"API Validation Error: {error_text}")
+                    raise ValueError(f"API Validation Error: {error_text}")
+
+                response.raise_for_status()
                     
-                    # Process the streaming response
-                    response_content = []
-                    async for line in response.content:
-                        decoded_line = line.decode('utf-8')
-                        if not decoded_line.strip():
+                # Process the streaming response
+                loop = asyncio.get_running_loop()
+                state = StreamState(loop=loop, last_flush=loop.time())
+                # Lines stay as bytes; the JSON parser takes them directly
+                # and only the extracted content strings are decoded.
+                # Reading in large chunks and splitting lines here lets one
+                # loop wake-up handle every frame that arrived together.
+                buf = bytearray()
+                done = False
+                reader = response.content
+                while True:
+                    if state.pending:
+                        # Coalesced content must not wait on the next frame;
+                        # flush it once its 20ms window has passed
+                        timeout = state.last_flush + 0.02 - loop.time()
+                        try:
+                            if timeout <= 0:
+                                raise asyncio.TimeoutError
+                            chunk = await asyncio.wait_for(reader.read(16384), timeout)
+                        except asyncio.TimeoutError:
+                            await self._flush_pending(event_emitter, state)
+                            continue
+                    else:
+                        chunk = await reader.read(16384)
+                    if not chunk:
+                        break
+                    if done:
+                        # Read the rest of the body so the connection can go
+                        # back to the pool instead of being closed
+                        continue
+                    buf += chunk
+                    start = 0
+                    while True:
+                        end = buf.find(b'\n', start)
+                        if end < 0:
+                            break
+                        line = buf[start:end]
+                        start = end + 1
+
+                        if not line.strip():
                             continue
 
-                        if self.valves.DEV_MODE:
-                            logger.debug(f"Raw chunk: {decoded_line}")
+                        if debug:
+                            logger.debug("Raw chunk: %s", line.decode('utf-8', errors='replace'))
 
-                        if not decoded_line.startswith('data: '):
+                        if not line.startswith(_DATA_PREFIX):
                             continue
 
-                        if decoded_line == 'data: [DONE]':
-                            if self.valves.DEV_MODE:
+                        if line.rstrip() == _DONE:
+                            if debug:
                                 logger.debug("Received [DONE] marker")
+                            done = True
                             break
 
                         try:
-                            chunk_data = json.loads(decoded_line[6:])
-                            message_type = chunk_data.get("message_type")
-
-                            if message_type == "assistant_message":
-                                content = chunk_data.get("content", "")
-                                if content:
-                                    response_content.append(content)
-                                    # Clear processing status
-                                    await self.emit_status(event_emitter, "info", "", True)
-                                    # Stream the content
-                                    await self.emit_message(event_emitter, content)
-
-                            elif message_type == "usage_statistics" and getattr(user_valves, "SHOW_USAGE_STATS", True):
-                                if self.valves.DEV_MODE:
-                                    logger.debug(f"Usage statistics: {chunk_data}")
-                                await event_emitter({
-                                    "type": "usage",
-                                    "data": chunk_data
-                                })
-
-                            elif message_type == "reasoning_message" and getattr(user_valves, "SHOW_REASONING", True):
-                                # Get the message directly
-                                message = chunk_data.get("message", "")
-                                if message:
-                                    if self.valves.DEV_MODE:
-                                        logger.debug(f"Reasoning message: {message}")
-
-                                    # Update status with reasoning message
-                                    await self.emit_status(
-                                        event_emitter,
-                                        "info",
-                                        f"🤔 {message}",
-                                        False
-                                    )
-                                    # Also emit reasoning event for other UI elements
-                                    await event_emitter({
-                                        "type": "reasoning",
-                                        "data": {
-                                            "message": message
-                                        }
-                                    })
+                            chunk_data = _loads(line[6:])
+                            handler = self._handlers.get(chunk_data.get("message_type"))
+                            if handler is not None:
+                                await handler(chunk_data, event_emitter, user_valves, state)
 
                         except json.JSONDecodeError as e:
                             if self.valves.DEV_MODE:
-                                logger.error(f"JSON Parse Error: {str(e)}")
-                                logger.error(f"Problem chunk: {decoded_line}")
+                                logger.error("JSON Parse Error: %s", e)
+                                logger.error("Problem chunk: %s", line.decode('utf-8', errors='replace'))
+
+                    if done:
+                        buf.clear()
+                        if event_emitter is not None:
+                            await self._flush_pending(event_emitter, state)
+                    else:
+                        del buf[:start]
+
+                if event_emitter is not None:
+                    await self._flush_pending(event_emitter, state)
 
-            return "\n".join(response_content)
+            response_text = state.response_content.getvalue()
+            self._log_response("assistant_response", response_text)
+            return response_text
 
         except aiohttp.ClientError as e:
             logger.error(f"Error communicating with Letta agent: {e}")
@@ -346,7 +582,7 @@ class Pipe:
                             "messages": body.get("messages", []),
                             "stream": False,
                         },
-                        user=User(**__user__)
+                        user=self._get_user(__user__)
                     )
                     if not response or "choices" not in response:
                         logger.error("Invalid response format")
@@ -365,10 +601,12 @@ class Pipe:
             # Process messages
             messages = body.get("messages", [])
             if not messages:
-                await self.emit_status(__event_emitter__, "error", "No messages provided", True)
+                if __event_emitter__ is not None:
+                    await self.emit_status(__event_emitter__, "error", "No messages provided", True)
                 return ""
 
-            await self.emit_status(__event_emitter__, "info", "🔄 Processing request...", False)
+            if __event_emitter__ is not None:
+                await self.emit_status(__event_emitter__, "info", "🔄 Processing request...", False)
 
             try:
                 response = await self.get_letta_response(
@@ -377,20 +615,23 @@ class Pipe:
                     user_valves=user_valves
                 )
                 
-                if self.valves.DEV_MODE:
-                    logger.debug(f"Letta agent response: {response}")
+                if self.valves.DEV_MODE and logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Letta agent response: %s", response)
                 
                 if response:
-                    await self.emit_status(__event_emitter__, "success", "✓ Response complete", True)
+                    if __event_emitter__ is not None:
+                        await self.emit_status(__event_emitter__, "success", "✓ Response complete", True)
                     return response
                 else:
-                    await self.emit_status(__event_emitter__, "error", "⚠️ Empty response from Letta agent", True)
+                    if __event_emitter__ is not None:
+                        await self.emit_status(__event_emitter__, "error", "⚠️ Empty response from Letta agent", True)
                     return ""
 
             except Exception as e:
                 error_msg = f"Error processing request: {str(e)}"
                 logger.error(error_msg)
-                await self.emit_status(__event_emitter__, "error", error_msg, True)
+                if __event_emitter__ is not None:
+                    await self.emit_status(__event_emitter__, "error", error_msg, True)
                 return ""
 
         except Exception as e:
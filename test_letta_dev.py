@@ -7,6 +7,21 @@ import sys
 import json
 import asyncio
 import pytest
+from collections import Counter
+
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumps_bytes = orjson.dumps
+except ImportError:
+    def _dumps_bytes(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+    _loads = json.loads
+
+# Set VERBOSE=1 to print every emitted event
+VERBOSE = os.getenv('VERBOSE') == '1'
 
 # Add OpenWebUI backend to Python path
 OPENWEBUI_BACKEND = os.path.abspath(os.path.join(os.path.dirname(__file__), '../open-webui/backend'))
@@ -45,20 +60,32 @@ class MockEventEmitter:
     def __init__(self, log_file="test_events.jsonl"):
         self.log_file = log_file
         self.events = []
-        # Create or clear the log file
-        with open(log_file, 'w') as f:
-            f.write(f"# Test Events Log - {datetime.now().isoformat()}\n")
+        # Create or clear the log file, keeping it open for the whole run
+        self._fh = open(log_file, 'wb')
+        self._fh.write(f"# Test Events Log - {datetime.now().isoformat()}\n".encode())
 
-    async def __call__(self, event):
+    async def __call__(self, event, case=None):
         self.events.append(event)
         # Log the event
-        with open(self.log_file, 'a') as f:
-            f.write(json.dumps({
-                "timestamp": datetime.now().isoformat(),
-                "event": event
-            }) + '\n')
+        self._fh.write(_dumps_bytes({
+            "timestamp": datetime.now().isoformat(),
+            "case": case,
+            "event": event
+        }) + b'\n')
         # Print event for debugging
-        print(f"\nEvent Emitted: {json.dumps(event, indent=2)}")
+        if VERBOSE:
+            print(f"\n[{case}] Event Emitted: {json.dumps(event, indent=2)}")
+
+    def for_case(self, case):
+        """Return an emitter that tags its events with the test case name"""
+        async def emit(event):
+            await self(event, case)
+        return emit
+
+    def close(self):
+        """Flush and close the event log"""
+        if not self._fh.closed:
+            self._fh.close()
 
 def setup_test_environment():
     """Setup test environment and validate configuration"""
@@ -66,16 +93,18 @@ def setup_test_environment():
     load_dotenv()
     
     # Validate required environment variables
-    required_vars = ['LETTA_BASE_URL', 'LETTA_AGENT_ID', 'LETTA_PASSWORD']
-    missing_vars = [var for var in required_vars if not os.getenv(var)]
+    env = os.environ
+    required_vars = ('LETTA_BASE_URL', 'LETTA_AGENT_ID', 'LETTA_PASSWORD')
+    missing_vars = [var for var in required_vars if not env.get(var)]
     if missing_vars:
         raise EnvironmentError(f"Missing required environment variables: {', '.join(missing_vars)}")
+    base_url, agent_id, password = (env[var] for var in required_vars)
     
     # Print test configuration
     print("\nTest Configuration:")
-    print(f"LETTA_BASE_URL: {os.getenv('LETTA_BASE_URL')}")
-    print(f"LETTA_AGENT_ID: {os.getenv('LETTA_AGENT_ID')}")
-    print(f"LETTA_PASSWORD: {'*' * len(os.getenv('LETTA_PASSWORD'))}")
+    print(f"LETTA_BASE_URL: {base_url}")
+    print(f"LETTA_AGENT_ID: {agent_id}")
+    print(f"LETTA_PASSWORD: {'*' * len(password)}")
 
 def configure_pipe_for_testing():
     """Configure Letta pipeline for testing"""
@@ -91,7 +120,7 @@ def configure_pipe_for_testing():
     
     return pipe
 
-async def process_message(pipe, message, event_emitter):
+async def process_message(pipe, name, message, event_emitter):
     """Process a test message and handle the response"""
     try:
         # Prepare test data
@@ -120,14 +149,14 @@ async def process_message(pipe, message, event_emitter):
         # Handle streaming response
         if hasattr(result, '__aiter__'):
             async for chunk in result:
-                print(f"\nResponse chunk: {chunk}")
+                print(f"\n[{name}] Response chunk: {chunk}")
         else:
-            print(f"\nFull response: {result}")
+            print(f"\n[{name}] Full response: {result}")
             
         return True
     
     except Exception as e:
-        print(f"\n❌ Error processing message: {str(e)}")
+        print(f"\n❌ [{name}] Error processing message: {str(e)}")
         return False
 
 @pytest.mark.asyncio
@@ -141,29 +170,41 @@ async def test_letta_pipeline():
         pipe = configure_pipe_for_testing()
         event_emitter = MockEventEmitter()
         
-        # Test results
-        results = []
-        
-        # Process each test message
         for test_case in TEST_MESSAGES:
             print(f"\n--- Testing: {test_case['name']} ---")
             print(f"Description: {test_case['description']}")
             print(f"Message: {test_case['message']}\n")
-            
-            success = await process_message(
-                pipe=pipe,
-                message=test_case['message'],
-                event_emitter=event_emitter
+        
+        try:
+            # The test cases share no state, so process them concurrently.
+            # Output and events are tagged with the case name to tell the
+            # interleaved streams apart
+            outcomes = await asyncio.gather(
+                *(
+                    process_message(
+                        pipe=pipe,
+                        name=test_case['name'],
+                        message=test_case['message'],
+                        event_emitter=event_emitter.for_case(test_case['name'])
+                    )
+                    for test_case in TEST_MESSAGES
+                ),
+                return_exceptions=True
             )
-            
-            results.append({
-                "test_case": test_case['name'],
-                "success": success
-            })
-            
-            # Add delay between tests
-            await asyncio.sleep(2)
+        finally:
+            # Drain queued response log entries before inspecting the logs
+            await pipe.on_shutdown()
+            event_emitter.close()
         
+        # Test results
+        results = [
+            {
+                "test_case": test_case['name'],
+                "success": outcome is True
+            }
+            for test_case, outcome in zip(TEST_MESSAGES, outcomes)
+        ]
+
         # Print test summary
         print("\n=== Test Summary ===")
         for result in results:
@@ -195,35 +236,31 @@ async def test_letta_pipeline():
 def analyze_logs():
     """Analyze test logs for patterns and issues"""
     try:
-        # Analyze response log
-        with open("test_responses.jsonl", 'r') as f:
-            responses = [json.loads(line) for line in f if line.strip() and not line.startswith('#')]
+        # Count response types line by line without keeping the entries
+        response_types = Counter()
+        with open("test_responses.jsonl", 'rb') as f:
+            for line in f:
+                if not line.strip() or line.startswith(b'#'):
+                    continue
+                response_types[_loads(line).get('type', 'unknown')] += 1
         
-        # Analyze event log
-        with open("test_events.jsonl", 'r') as f:
-            events = [json.loads(line) for line in f if line.strip() and not line.startswith('#')]
+        # Count event types the same way
+        event_types = Counter()
+        with open("test_events.jsonl", 'rb') as f:
+            for line in f:
+                if not line.strip() or line.startswith(b'#'):
+                    continue
+                event_types[_loads(line).get('event', {}).get('type', 'unknown')] += 1
         
         # Print analysis
         print("\n=== Log Analysis ===")
-        print(f"Total responses: {len(responses)}")
-        print(f"Total events: {len(events)}")
-        
-        # Response types
-        response_types = {}
-        for r in responses:
-            r_type = r.get('type', 'unknown')
-            response_types[r_type] = response_types.get(r_type, 0) + 1
+        print(f"Total responses: {sum(response_types.values())}")
+        print(f"Total events: {sum(event_types.values())}")
         
         print("\nResponse Types:")
         for r_type, count in response_types.items():
             print(f"- {r_type}: {count}")
         
-        # Event types
-        event_types = {}
-        for e in events:
-            e_type = e.get('event', {}).get('type', 'unknown')
-            event_types[e_type] = event_types.get(e_type, 0) + 1
-        
         print("\nEvent Types:")
         for e_type, count in event_types.items():
             print(f"- {e_type}: {count}")
@@ -3,8 +3,20 @@ import json
 import requests
 from dotenv import load_dotenv
 
+try:
+    import orjson
+
+    _dumps_bytes = orjson.dumps
+except ImportError:
+    def _dumps_bytes(obj) -> bytes:
+        return json.dumps(obj).encode()
+
 OPENWEBUI_URL = "https://llm.oculair.ca"
 
+# Shared session so repeated uploads reuse the keep-alive TLS connection
+_SESSION = requests.Session()
+_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
 def get_jwt_token():
     load_dotenv()
     token = os.getenv("OPENWEBUI_JWT_TOKEN")
@@ -28,7 +40,7 @@ def upload_function(name, content, description=""):
     # First try to delete the function if it exists
     delete_url = f"{OPENWEBUI_URL}/api/v1/functions/id/{function_id}/delete"
     try:
-        requests.delete(delete_url, headers=headers)
+        _SESSION.delete(delete_url, headers=headers)
         print("Deleted existing function...")
     except requests.exceptions.RequestException:
         pass
@@ -49,8 +61,8 @@ def upload_function(name, content, description=""):
         print("Creating new function...")
         print(f"URL: {url}")
         print(f"Headers: {headers}")
-        print(f"Payload: {json.dumps(payload, indent=2)}")
-        response = requests.post(url, headers=headers, json=payload)
+        print(f"Payload: id={function_id}, name={name}, content={len(content)} chars")
+        response = _SESSION.post(url, headers=headers, data=_dumps_bytes(payload))
         print(f"Response Status: {response.status_code}")
         print(f"Response Text: {response.text}")
         response.raise_for_status()
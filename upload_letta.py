@@ -1,8 +1,8 @@
+from pathlib import Path
 from upload_function_to_openwebui_ import upload_function
 
 # Read the letta.py file
-with open('letta_improved.py', 'r') as f:
-    letta_content = f.read()
+letta_content = Path('letta_improved.py').read_bytes().decode('utf-8')
 
 # Upload the function
 result = upload_function(